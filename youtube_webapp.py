@@ -1,110 +1,183 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from googleapiclient.discovery import build
 from datetime import datetime, timezone, timedelta
 import io
 import re
+import asyncio
+import aiohttp
 
 # --- 설정값 ---
 SEARCH_PERIOD_DAYS = 90 # 인기 동영상 검색 기간 (일)
+YOUTUBE_API_BASE_URL = "https://www.googleapis.com/youtube/v3"
+API_MAX_CONCURRENCY = 8 # 동시 API 요청 수 (쿼터 보호)
+API_MAX_RETRIES = 3 # 429/5xx 응답 시 재시도 횟수
+VIDEOS_LIST_MAX_IDS = 50 # videos.list 한 번에 조회 가능한 최대 영상 ID 수
 
 # --- 공통 함수: 유튜브 영상 길이(ISO 8601)를 초 단위로 변환 ---
+# 24시간 이상 영상은 P1DT2H…, 라이브·예정 방송은 P0D 형태이므로 일(D) 단위와 선택적 T 구간까지 처리
+ISO8601_DURATION_PATTERN = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+DURATION_UNIT_SECONDS = np.array([86400, 3600, 60, 1], dtype='float32')
+
 def parse_iso8601_duration(duration):
-    match = re.match(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', duration).groups()
-    hours = int(match[0]) if match[0] else 0; minutes = int(match[1]) if match[1] else 0; seconds = int(match[2]) if match[2] else 0
-    return hours * 3600 + minutes * 60 + seconds
+    match = ISO8601_DURATION_PATTERN.match(duration).groups()
+    days = int(match[0]) if match[0] else 0; hours = int(match[1]) if match[1] else 0; minutes = int(match[2]) if match[2] else 0; seconds = int(match[3]) if match[3] else 0
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+def parse_iso8601_durations(durations):
+    parts = durations.str.extract(ISO8601_DURATION_PATTERN).astype('float32').fillna(0)
+    return parts.values @ DURATION_UNIT_SECONDS
+
+# --- 공통 예외: YouTube Data API 오류 응답 (요청 URL에 API 키가 있으므로 메시지에 URL을 넣지 않음) ---
+class YouTubeAPIError(Exception):
+    pass
+
+async def api_error_from_response(response):
+    try: payload = await response.json(content_type=None)
+    except ValueError: payload = None
+    error = payload.get('error', {}) if isinstance(payload, dict) else {}
+    message = error.get('message') or response.reason
+    reasons = ', '.join(err['reason'] for err in error.get('errors', []) if err.get('reason'))
+    return YouTubeAPIError(f"{response.status} {message}" + (f" ({reasons})" if reasons else ""))
+
+# --- 공통 함수: YouTube Data API 비동기 호출 (429/5xx는 지수 백오프로 재시도) ---
+async def fetch_api_json(session, semaphore, endpoint, params):
+    async with semaphore:
+        for attempt in range(API_MAX_RETRIES + 1):
+            async with session.get(f"{YOUTUBE_API_BASE_URL}/{endpoint}", params=params) as response:
+                if response.status < 400: return await response.json(content_type=None)
+                if (response.status != 429 and response.status < 500) or attempt == API_MAX_RETRIES:
+                    raise await api_error_from_response(response)
+            await asyncio.sleep(2 ** attempt)
+
+# --- API 호출 함수: 카테고리별 인기 영상 검색 후 영상 상세 정보를 50개씩 조회 (한 세션·세마포어로 동시 요청) ---
+async def fetch_popular_video_items(api_key, category_ids, start_date):
+    semaphore = asyncio.Semaphore(API_MAX_CONCURRENCY)
+    async with aiohttp.ClientSession() as session:
+        async def _search(cat_id):
+            params = {'key': api_key, 'part': 'id', 'type': 'video', 'videoCategoryId': cat_id, 'maxResults': 25, 'order': 'viewCount', 'regionCode': 'KR', 'relevanceLanguage': 'ko', 'publishedAfter': start_date}
+            return await fetch_api_json(session, semaphore, 'search', params)
+        async def _videos(chunk):
+            params = {'key': api_key, 'part': 'snippet,statistics,contentDetails', 'id': ','.join(chunk)}
+            return await fetch_api_json(session, semaphore, 'videos', params)
+        all_video_ids = set()
+        for search_response in await asyncio.gather(*[_search(cat_id) for cat_id in category_ids]):
+            all_video_ids |= {item['id']['videoId'] for item in search_response.get('items', ())}
+        video_ids = list(all_video_ids)
+        chunks = [video_ids[i:i + VIDEOS_LIST_MAX_IDS] for i in range(0, len(video_ids), VIDEOS_LIST_MAX_IDS)]
+        video_responses = await asyncio.gather(*[_videos(chunk) for chunk in chunks])
+    return [item for response in video_responses for item in response.get('items', [])]
+
+# --- 공통 함수: 유튜브 API 클라이언트 생성 (세션마다 하나, 재실행 간 재사용) ---
+# 클라이언트의 httplib2.Http는 스레드 안전하지 않고 세션마다 별도 스레드에서 스크립트가 실행되므로 세션 간에는 공유하지 않음
+def get_youtube_client(api_key):
+    if 'youtube_client' not in st.session_state:
+        st.session_state.youtube_client = build('youtube', 'v3', developerKey=api_key, cache_discovery=False)
+    return st.session_state.youtube_client
 
 # --- API 호출 함수: 유튜브 카테고리 목록 가져오기 ---
-@st.cache_data
+@st.cache_data(persist="disk") # 카테고리는 거의 바뀌지 않으므로 앱 재시작 후에도 재사용
 def get_video_categories(_youtube, region_code='KR'):
     request = _youtube.videoCategories().list(part="snippet", regionCode=region_code, hl='ko'); response = request.execute()
     return {item['id']: item['snippet']['title'] for item in response['items']}
 
 # --- 공통 함수: API 응답 결과를 데이터프레임으로 변환 ---
 def process_video_items(items, category_map):
-    video_data = []; now_utc = datetime.now(timezone.utc)
-    for item in items:
-        stats = item.get('statistics', {}); view_count = int(stats.get('viewCount', 0)); like_count = int(stats.get('likeCount', 0)); comment_count = int(stats.get('commentCount', 0))
-        engagement_rate = (like_count / view_count) * 100 if view_count > 0 else 0
-        video_url = f"https://www.youtube.com/watch?v={item['id']}"; published_at_str = item['snippet']['publishedAt']
-        published_at_dt = datetime.fromisoformat(published_at_str.replace('Z', '+00:00')); time_since_published = now_utc - published_at_dt
-        hours_since_published = max(1, time_since_published.total_seconds() / 3600); views_per_hour = int(view_count / hours_since_published)
-        upload_date_display = published_at_dt.strftime('%Y-%m-%d'); duration_iso = item['contentDetails']['duration']
-        duration_seconds = parse_iso8601_duration(duration_iso); video_type = "숏폼 (Shorts)" if duration_seconds <= 60 else "롱폼 (Long-form)"
-        category_id = item['snippet'].get('categoryId', ''); category_name = category_map.get(category_id, "기타")
-        video_data.append({'제목': item['snippet']['title'], '조회수': view_count, '시간당 조회수': views_per_hour, '좋아요 수': like_count, '댓글 수': comment_count, '반응률 (%)': engagement_rate, '게시일': upload_date_display, '채널명': item['snippet']['channelTitle'], '카테고리': category_name, '영상 종류': video_type, 'URL': video_url})
-    df = pd.DataFrame(video_data); column_order = ['제목', '조회수', '시간당 조회수', '좋아요 수', '댓글 수', '반응률 (%)', '게시일', '채널명', '카테고리', '영상 종류', 'URL']
-    return df[column_order]
+    column_order = ['제목', '조회수', '시간당 조회수', '좋아요 수', '댓글 수', '반응률 (%)', '게시일', '채널명', '카테고리', '영상 종류', 'URL']
+    column_dtypes = {'조회수': 'int64', '시간당 조회수': 'int32', '좋아요 수': 'int32', '댓글 수': 'int32', '반응률 (%)': 'float32', '채널명': 'category', '카테고리': 'category', '영상 종류': 'category'} # 조회수는 20억을 넘을 수 있어 int64 유지
+    if not items: return pd.DataFrame(columns=column_order).astype(column_dtypes)
+    ids, snippets, stats_l, cd_l = zip(*[(item['id'], item['snippet'], item.get('statistics', {}), item['contentDetails']) for item in items])
+    snippet_df = pd.DataFrame(list(snippets)).reindex(columns=['title', 'publishedAt', 'channelTitle', 'categoryId'])
+    stats_df = pd.DataFrame(list(stats_l)).reindex(columns=['viewCount', 'likeCount', 'commentCount']).apply(pd.to_numeric, errors='coerce').fillna(0).astype('int64')
+    view_count = stats_df['viewCount']; like_count = stats_df['likeCount']; comment_count = stats_df['commentCount']
+    views = view_count.to_numpy(dtype='float64')
+    engagement_rate = np.divide(like_count.to_numpy() * 100.0, views, out=np.zeros_like(views), where=views > 0)
+    published_at = pd.to_datetime(snippet_df['publishedAt'], utc=True, format='ISO8601')
+    hours_since_published = np.maximum((pd.Timestamp.now(tz='UTC') - published_at).dt.total_seconds().to_numpy() / 3600, 1)
+    views_per_hour = (views / hours_since_published).astype('int64')
+    duration_seconds = parse_iso8601_durations(pd.Series([cd['duration'] for cd in cd_l]))
+    video_type = np.where((duration_seconds > 0) & (duration_seconds <= 60), "숏폼 (Shorts)", "롱폼 (Long-form)") # 길이 0(P0D)은 라이브·예정 방송이므로 숏폼이 아님
+    category_name = snippet_df['categoryId'].map(category_map).fillna("기타")
+    df = pd.DataFrame({'제목': snippet_df['title'], '조회수': view_count, '시간당 조회수': views_per_hour, '좋아요 수': like_count, '댓글 수': comment_count, '반응률 (%)': engagement_rate, '게시일': published_at.dt.strftime('%Y-%m-%d'), '채널명': snippet_df['channelTitle'], '카테고리': category_name, '영상 종류': video_type, 'URL': "https://www.youtube.com/watch?v=" + pd.Series(ids)})
+    return df.astype(column_dtypes)[column_order]
 
 # --- API 호출 함수 1: 키워드 검색 ---
-def get_youtube_data(youtube, category_map, query, max_results=50):
-    try:
-        search_request = youtube.search().list(q=query, part='id', type='video', maxResults=max_results, order='relevance', regionCode='KR', relevanceLanguage='ko')
-        search_response = search_request.execute()
-        video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
-        if not video_ids: return None
-        video_request = youtube.videos().list(part="snippet,statistics,contentDetails", id=','.join(video_ids)); video_response = video_request.execute()
-        df = process_video_items(video_response.get('items', []), category_map)
-        df.dropna(subset=['조회수'], inplace=True)
-        
-        # ▼▼▼ [수정된 부분] 제목에 한글이 없는 영상을 제외합니다. ▼▼▼
-        df = df[df['제목'].str.contains(r'[가-힣]', na=False)]
-        
-        return df.sort_values(by='조회수', ascending=False)
-    except Exception as e:
-        st.error(f"검색 중 오류: {e}"); return None
+@st.cache_data(ttl=600, max_entries=128, show_spinner=False)
+def get_youtube_data(_youtube, category_map, query, max_results=50):
+    search_request = _youtube.search().list(q=query, part='id', type='video', maxResults=max_results, order='relevance', regionCode='KR', relevanceLanguage='ko')
+    search_response = search_request.execute()
+    video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
+    if not video_ids: return None
+    video_request = _youtube.videos().list(part="snippet,statistics,contentDetails", id=','.join(video_ids)); video_response = video_request.execute()
+    df = process_video_items(video_response.get('items', []), category_map)
+    df.dropna(subset=['조회수'], inplace=True)
+    
+    # ▼▼▼ [수정된 부분] 제목에 한글이 없는 영상을 제외합니다. ▼▼▼
+    df = df[df['제목'].str.contains(r'[가-힣]', na=False)]
+    
+    return df.sort_values(by='조회수', ascending=False)
 
 # --- API 호출 함수 2: 카테고리별 종합 인기 동영상 ---
-@st.cache_data
-def get_comprehensive_popular_videos(_youtube, category_map):
+@st.cache_data(ttl=1800)
+def get_comprehensive_popular_videos(api_key, category_map):
     try:
         excluded_categories = ['음악', '게임']
-        excluded_ids = [cat_id for cat_id, cat_name in category_map.items() if cat_name in excluded_categories]
-        all_video_ids = set()
+        excluded_ids = frozenset(cat_id for cat_id, cat_name in category_map.items() if cat_name in excluded_categories)
         start_date = (datetime.now(timezone.utc) - timedelta(days=SEARCH_PERIOD_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
-        for cat_id, cat_name in category_map.items():
-            if cat_id in excluded_ids: continue
-            search_request = _youtube.search().list(
-                part='id', type='video', videoCategoryId=cat_id,
-                maxResults=25, order='viewCount', regionCode='KR',
-                relevanceLanguage='ko', publishedAfter=start_date
-            )
-            search_response = search_request.execute()
-            for item in search_response.get('items', []):
-                all_video_ids.add(item['id']['videoId'])
-        if not all_video_ids: return None
-        video_ids_list = list(all_video_ids)
-        video_request = _youtube.videos().list(part="snippet,statistics,contentDetails", id=','.join(video_ids_list))
-        video_response = video_request.execute()
-        df = process_video_items(video_response.get('items', []), category_map)
+        category_ids = [cat_id for cat_id in category_map if cat_id not in excluded_ids]
+        video_items = asyncio.run(fetch_popular_video_items(api_key, category_ids, start_date))
+        if not video_items: return None
+        df = process_video_items(video_items, category_map)
         df.dropna(subset=['조회수'], inplace=True)
 
         # ▼▼▼ [수정된 부분] 제목에 한글이 없는 영상을 제외합니다. ▼▼▼
         df = df[df['제목'].str.contains(r'[가-힣]', na=False)]
         
-        return df.sort_values(by='조회수', ascending=False).head(200)
+        return df.nlargest(200, '조회수')
     except Exception as e:
         st.error(f"카테고리별 인기 동영상 로딩 중 오류: {e}")
         return None
 
+# --- 공통 함수: 엑셀 다운로드 파일 생성 (같은 결과는 캐시 재사용) ---
+@st.cache_data(ttl=600, max_entries=128)
+def build_xlsx(df):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
+    return output.getvalue()
+
+# --- UI 함수: 카테고리별 인기 동영상 표 (카테고리 선택 시 이 영역만 다시 실행) ---
+@st.fragment
+def render_popular_panel(df_popular, category_groups):
+    all_categories = sorted(category_groups)
+    all_categories.insert(0, "전체")
+    selected_category = st.selectbox('🗂️ 표시할 카테고리를 선택하세요:', all_categories)
+    if selected_category == "전체": display_df = df_popular
+    else: display_df = category_groups[selected_category]
+    st.dataframe(display_df, height=800, column_config={"조회수": st.column_config.NumberColumn(format="%d"), "시간당 조회수": st.column_config.NumberColumn(format="%d"),"좋아요 수": st.column_config.NumberColumn(format="%d"), "댓글 수": st.column_config.NumberColumn(format="%d"),"반응률 (%)": st.column_config.NumberColumn(format="%.2f%%"), "URL": st.column_config.LinkColumn("영상 링크", display_text="바로가기 ↗")})
+
 # --- Streamlit 웹 UI 구성 ---
 st.set_page_config(page_title="📈 유튜브 영상 분석기", page_icon="📈", layout="wide")
 st.title("📈 유튜브 인기 영상 분석기"); st.markdown("---")
 try: api_key = st.secrets["YOUTUBE_API_KEY"]
 except KeyError: st.error("🔑 Streamlit Secrets에 API 키가 설정되지 않았습니다. 앱 설정(Manage app)에서 추가해주세요."); st.stop()
-youtube = build('youtube', 'v3', developerKey=api_key); category_map = get_video_categories(youtube)
+youtube = get_youtube_client(api_key); category_map = get_video_categories(youtube)
 if 'comprehensive_data' not in st.session_state:
-    st.session_state.comprehensive_data = get_comprehensive_popular_videos(youtube, category_map)
+    st.session_state.comprehensive_data = get_comprehensive_popular_videos(api_key, category_map)
+if 'comprehensive_groups' not in st.session_state:
+    df_popular = st.session_state.comprehensive_data
+    st.session_state.comprehensive_groups = {cat: sub for cat, sub in df_popular.groupby('카테고리', observed=True)} if df_popular is not None else {}
 st.header("1. 키워드 검색 분석")
 with st.form(key="search_form"):
     search_query = st.text_input("검색어 입력창", placeholder="🔍 분석하고 싶은 검색어를 입력하세요.", label_visibility="collapsed")
     submit_button = st.form_submit_button(label="📊 분석 시작!")
 if submit_button and search_query:
-    with st.spinner('데이터를 가져오는 중입니다...'): df_results = get_youtube_data(youtube, category_map, search_query)
+    try:
+        with st.spinner('데이터를 가져오는 중입니다...'): df_results = get_youtube_data(youtube, category_map, search_query)
+    except Exception as e:
+        st.error(f"검색 중 오류: {e}"); df_results = None
     if df_results is not None and not df_results.empty:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer: df_results.to_excel(writer, index=False, sheet_name='Sheet1')
-        excel_data = output.getvalue()
+        excel_data = build_xlsx(df_results)
         col1, col2 = st.columns([0.8, 0.2])
         with col1: st.header("분석 결과")
         with col2: st.download_button(label="📁 엑셀 파일 다운로드", data=excel_data, file_name=f"youtube_analysis_{search_query}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
@@ -113,10 +186,4 @@ if submit_button and search_query:
 st.markdown("---");
 st.header(f"2. 카테고리별 종합 인기 동영상 (최근 {SEARCH_PERIOD_DAYS}일, TOP 200)")
 df_popular = st.session_state.comprehensive_data
-if df_popular is not None:
-    all_categories = sorted(df_popular['카테고리'].unique())
-    all_categories.insert(0, "전체")
-    selected_category = st.selectbox('🗂️ 표시할 카테고리를 선택하세요:', all_categories)
-    if selected_category == "전체": display_df = df_popular
-    else: display_df = df_popular[df_popular['카테고리'] == selected_category]
-    st.dataframe(display_df, height=800, column_config={"조회수": st.column_config.NumberColumn(format="%d"), "시간당 조회수": st.column_config.NumberColumn(format="%d"),"좋아요 수": st.column_config.NumberColumn(format="%d"), "댓글 수": st.column_config.NumberColumn(format="%d"),"반응률 (%)": st.column_config.NumberColumn(format="%.2f%%"), "URL": st.column_config.LinkColumn("영상 링크", display_text="바로가기 ↗")})
+if df_popular is not None: render_popular_panel(df_popular, st.session_state.comprehensive_groups)